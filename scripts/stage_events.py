@@ -0,0 +1,260 @@
+# Processing of the bugs into stage events. It is a module, so the worker
+# processes of `stages.py` can import it with any multiprocessing start method.
+from enum import Enum, auto
+from bugbug import bugzilla
+from collections import Counter
+import orjson
+import re
+
+OLDEST_BUG = "2020-01-01"
+
+CREATION_TIME_PAT = re.compile(rb'"creation_time":"(\d{4}-\d{2}-\d{2})')
+
+NI_PREFIX = "needinfo?("
+NI_PAT = re.compile(r"needinfo\?\((.*?)\)")
+
+
+class Stage(Enum):
+    NOTHING = auto()
+    NO_COMPONENT = auto()
+    UNCONFIRMED = auto()
+    CONFIRMED = auto()
+    PENDING_NEEDINFO = auto()
+    ANSWERED_NEEDINFO = auto()
+    TRIAGED = auto()
+    ASSIGNED = auto()
+    IN_REVIEW = auto()
+    RESOLVED = auto()
+
+    def __lt__(self, other):
+        return self.value < other.value
+
+    def __str__(self) -> str:
+        return self.name.capitalize().replace("_", " ")
+
+
+S_NOTHING = Stage.NOTHING.value
+S_NO_COMPONENT = Stage.NO_COMPONENT.value
+S_UNCONFIRMED = Stage.UNCONFIRMED.value
+S_CONFIRMED = Stage.CONFIRMED.value
+S_PENDING_NEEDINFO = Stage.PENDING_NEEDINFO.value
+S_ANSWERED_NEEDINFO = Stage.ANSWERED_NEEDINFO.value
+S_TRIAGED = Stage.TRIAGED.value
+S_ASSIGNED = Stage.ASSIGNED.value
+S_IN_REVIEW = Stage.IN_REVIEW.value
+S_RESOLVED = Stage.RESOLVED.value
+
+
+def status_to_stage(status):
+    if status == "UNCONFIRMED":
+        return Stage.UNCONFIRMED
+    if status in ("NEW", "REOPENED"):
+        return Stage.CONFIRMED
+    if status == "ASSIGNED":
+        return Stage.ASSIGNED
+    if status == "REVIEW":
+        return Stage.IN_REVIEW
+    if status in ("RESOLVED", "VERIFIED", "CLOSED"):
+        return Stage.RESOLVED
+
+    raise ValueError(f"Unknown status `{status}`")
+
+
+def get_current_stage(bug):
+    stage = status_to_stage(bug["status"])
+
+    if stage != Stage.RESOLVED:
+        if any(attachment["is_patch"] for attachment in bug["attachments"]):
+            return Stage.IN_REVIEW
+
+        if bug["severity"] not in ("n/a", "--"):
+            return Stage.TRIAGED
+
+    return stage
+
+
+def default_filter(bug):
+    return (
+        bug["type"] != "defect"
+        or bug["product"] == "Invalid Bugs"
+        or bug["creation_time"] < OLDEST_BUG
+    )
+
+
+# Check whether a bugs DB line is for a bug created before OLDEST_BUG, without
+# decoding it. Attachments and comments have a creation time too, but they
+# can't be older than the bug, so the bug is too old if all of them are.
+def is_created_before_oldest_bug(line):
+    oldest_bug = OLDEST_BUG.encode()
+
+    found = False
+    for match in CREATION_TIME_PAT.finditer(line):
+        if match[1] >= oldest_bug:
+            return False
+        found = True
+
+    return found
+
+
+# Same filtering as `bugzilla.get_bugs()`
+def load_bug(line):
+    bug = orjson.loads(line)
+    if bug["product"] not in bugzilla.PRODUCTS or bug["product"] == "Invalid Bugs":
+        return None
+
+    return bug
+
+
+def parse_needinfos(flags):
+    return NI_PAT.findall(flags) if NI_PREFIX in flags else []
+
+
+def remove_needinfo(needinfos, email):
+    if not needinfos[email]:
+        raise ValueError(f"No pending needinfo for `{email}`")
+
+    needinfos[email] -= 1
+    if not needinfos[email]:
+        del needinfos[email]
+
+
+def get_bug_events(bug):
+    bug_events = []
+
+    current_needinfos = Counter()
+    needinfo_events = [
+        {
+            "time": bug["creation_time"],
+            "add": [],
+            "remove": [],
+        }
+    ]
+
+    is_confirmed_after_open = False
+    is_severity_changed = False
+    is_moved_to_component_after_open = False
+
+    # Get stage changing events from the bug history
+    for event in bug["history"]:
+        for change in event["changes"]:
+            if change["field_name"] == "status":
+                bug_events.append(
+                    (
+                        event["when"],
+                        status_to_stage(change["added"]).value,
+                    )
+                )
+                if change["removed"] == "UNCONFIRMED":
+                    is_confirmed_after_open = True
+
+            elif change["field_name"] == "severity":
+                if not is_severity_changed and change["added"] not in ("n/a", "--"):
+                    is_severity_changed = True
+                    bug_events.append(
+                        (
+                            event["when"],
+                            S_TRIAGED,
+                        )
+                    )
+            elif change["field_name"] == "component":
+                if (
+                    not is_moved_to_component_after_open
+                    and change["added"] != "Untriaged"
+                ):
+                    is_moved_to_component_after_open = True
+                    # If the bug was confirmed at this time, this even will be filtered out
+                    bug_events.append((event["when"], S_UNCONFIRMED))
+            elif change["field_name"] == "flagtypes.name":
+                removed_needinfos = parse_needinfos(change["removed"])
+                added_needinfos = parse_needinfos(change["added"])
+                needinfo_events.append(
+                    {
+                        "time": event["when"],
+                        "add": added_needinfos,
+                        "remove": removed_needinfos,
+                    }
+                )
+                for email in removed_needinfos:
+                    try:
+                        remove_needinfo(current_needinfos, email)
+                    except ValueError:
+                        # This means that the needinfo was added at the creation time
+                        needinfo_events[0]["add"].append(email)
+
+                current_needinfos.update(added_needinfos)
+
+    # Add needinfos that was added at the creation time and still pending
+    needinfo_events[0]["add"].extend(
+        flag["requestee"]
+        for flag in bug["flags"]
+        if flag["name"] == "needinfo" and flag["requestee"] not in current_needinfos
+    )
+
+    # Convert needinfo events to stage events
+    current_needinfos = Counter()  # reset the counter
+    for event in needinfo_events:
+        was_pending = len(current_needinfos) > 0
+        for email in event["remove"]:
+            remove_needinfo(current_needinfos, email)
+        current_needinfos.update(event["add"])
+
+        if was_pending and len(current_needinfos) == 0:
+            bug_events.append(
+                (
+                    event["time"],
+                    S_ANSWERED_NEEDINFO,
+                )
+            )
+
+        elif not was_pending and len(current_needinfos) > 0:
+            bug_events.append(
+                (
+                    event["time"],
+                    S_PENDING_NEEDINFO,
+                )
+            )
+
+    # Get the date for the first patch
+    first_patch_at = min(
+        (
+            attachment["creation_time"]
+            for attachment in bug["attachments"]
+            if attachment["is_patch"]
+        ),
+        default=None,
+    )
+    if first_patch_at:
+        bug_events.append((first_patch_at, S_IN_REVIEW))
+
+    creation_stage = (
+        S_NO_COMPONENT
+        if is_moved_to_component_after_open or bug["component"] == "Untriaged"
+        else (
+            S_UNCONFIRMED
+            if is_confirmed_after_open or bug["status"] == "UNCONFIRMED"
+            else S_CONFIRMED
+        )
+    )
+    bug_events.append((bug["creation_time"], creation_stage))
+
+    return bug_events
+
+
+# Runs in the worker processes, which also skip and decode the bugs DB lines.
+# The bugs are filtered with `default_filter`, since the bugs created before
+# OLDEST_BUG are skipped regardless and a filter would need to be picklable.
+def process_bug_lines(lines):
+    results = []
+    for line in lines:
+        if is_created_before_oldest_bug(line):
+            continue
+
+        bug = load_bug(line)
+        if bug is None or default_filter(bug):
+            continue
+
+        results.append(
+            (bug["id"], bug["product"], bug["component"], get_bug_events(bug))
+        )
+
+    return results